@@ -1,83 +1,55 @@
 #!/usr/bin/env python3
+from __future__ import annotations
+
 import argparse
-import os
 import sys
-import time
-from datetime import timedelta
-from typing import Optional
-
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
-from spotipy.cache_handler import CacheFileHandler
-
-# -------- Auth --------
-
-SCOPES = [
-    "user-read-playback-state",
-    "user-modify-playback-state",
-    "user-read-currently-playing",
-]
-SCOPE_STR = " ".join(SCOPES)
-
-def make_spotify_client() -> spotipy.Spotify:
-    client_id = os.getenv("SPOTIPY_CLIENT_ID")
-    client_secret = os.getenv("SPOTIPY_CLIENT_SECRET")
-    redirect_uri = os.getenv("SPOTIPY_REDIRECT_URI", "http://localhost:8080/callback")
-
-    if not client_id or not client_secret:
-        print("[!] Missing credentials. Set SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET.", file=sys.stderr)
-        print("    You can use a .env file or export shell variables.", file=sys.stderr)
-        sys.exit(1)
-
-    cache_path = os.path.expanduser("~/.config/spotify-cli/.cache")
-    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-
-    auth_manager = SpotifyOAuth(
-        client_id=client_id,
-        client_secret=client_secret,
-        redirect_uri=redirect_uri,
-        scope=SCOPE_STR,
-        cache_handler=CacheFileHandler(cache_path),
-        open_browser=True,
-        show_dialog=False,
-    )
-    return spotipy.Spotify(auth_manager=auth_manager)
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional
+
+from spotify_core import (
+    REPEAT_STATES,
+    SEARCH_RESULT_KEYS,
+    SEARCH_TYPES,
+    SHUFFLE_STATES,
+    find_device,
+    get_devices,
+    handle_spotify_exception,
+    invalidate_devices,
+    make_spotify_client,
+    print_devices,
+    print_search_results,
+    print_status,
+    spotify_error,
+)
+
+if TYPE_CHECKING:
+    import spotipy
+
+# Shared pool for overlapping independent API round-trips.
+_executor = ThreadPoolExecutor(max_workers=4)
 
 # -------- Helpers --------
 
-def ms_to_mmss(ms: int) -> str:
-    if ms is None:
-        return "--:--"
-    s = int(ms // 1000)
-    return f"{s // 60:02d}:{s % 60:02d}"
-
-def get_devices(sp: spotipy.Spotify):
-    d = sp.devices()
-    return d.get("devices", [])
-
-def find_device(sp: spotipy.Spotify, query: str) -> Optional[str]:
-    """Return device_id matching id or (case-insensitive) substring of the device name."""
-    for dev in get_devices(sp):
-        if dev["id"] == query:
-            return dev["id"]
-        if query.lower() in dev["name"].lower():
-            return dev["id"]
-    return None
-
 def ensure_device(sp: spotipy.Spotify, device: Optional[str], force_play: bool=False) -> Optional[str]:
-    """Return a device_id. If 'device' is given, try to transfer playback there."""
-    if device:
-        target = find_device(sp, device)
-        if not target:
-            print(f"[!] No device matching '{device}' found. Use `devices` to list.", file=sys.stderr)
-            sys.exit(1)
-        try:
-            sp.transfer_playback(device_id=target, force_play=force_play)
-        except spotipy.SpotifyException as e:
-            handle_spotify_exception(e, "transfer playback")
-        return target
+    """Return a device_id. If 'device' is given, try to transfer playback there.
+
+    Without one, return None and let Spotify target the active device (see `on_device`).
+    """
+    if not device:
+        return None
+    target = find_device(sp, device)
+    if not target:
+        print(f"[!] No device matching '{device}' found. Use `devices` to list.", file=sys.stderr)
+        sys.exit(1)
+    try:
+        sp.transfer_playback(device_id=target, force_play=force_play)
+        invalidate_devices(sp)
+    except spotify_error() as e:
+        handle_spotify_exception(e, "transfer playback")
+    return target
 
-    # If no device specified, prefer the currently active one if any
+def default_device(sp: spotipy.Spotify) -> Optional[str]:
+    # Prefer the currently active device if any
     devices = get_devices(sp)
     for dev in devices:
         if dev.get("is_active"):
@@ -87,55 +59,22 @@ def ensure_device(sp: spotipy.Spotify, device: Optional[str], force_play: bool=F
         return devices[0]["id"]
     return None
 
-def handle_spotify_exception(e: spotipy.SpotifyException, action: str):
-    status = getattr(e, "http_status", None)
-    msg = getattr(e, "msg", str(e))
-    if status == 403:
-        print(f"[!] Spotify API rejected the request (403) while trying to {action}.", file=sys.stderr)
-        print("    Playback control via Web API requires Spotify Premium.", file=sys.stderr)
-    elif status == 404:
-        print(f"[!] Resource not found while trying to {action}.", file=sys.stderr)
-    elif status == 401:
-        print(f"[!] Unauthorized (401). Your token may be expired. Try deleting the cache and re-auth.", file=sys.stderr)
-    else:
-        print(f"[!] Spotify API error during {action}: {msg}", file=sys.stderr)
-    sys.exit(1)
-
-def print_devices(sp: spotipy.Spotify):
-    devices = get_devices(sp)
-    if not devices:
-        print("No available devices. Open Spotify on at least one device, then try again.")
-        return
-    print("Devices:")
-    for dev in devices:
-        active = " (active)" if dev.get("is_active") else ""
-        vol = dev.get("volume_percent")
-        vol_str = f" vol={vol}%" if vol is not None else ""
-        print(f" - {dev['name']} [{dev['type']}] id={dev['id']}{active}{vol_str}")
-
-def print_status(sp: spotipy.Spotify):
-    pb = sp.current_playback()
-    if not pb:
-        print("Nothing is playing.")
-        return
-    item = pb.get("item")
-    is_playing = pb.get("is_playing")
-    device = pb.get("device", {})
-    progress = pb.get("progress_ms", 0)
-    shuffle = pb.get("shuffle_state")
-    repeat = pb.get("repeat_state")
-    name = item.get("name") if item else "—"
-    artists = ", ".join(a["name"] for a in (item.get("artists") or [])) if item else "—"
-    duration = item.get("duration_ms") if item else None
-
-    print(f"{'▶️' if is_playing else '⏸️'} {name} — {artists}")
-    print(f"Device: {device.get('name','?')}  |  {ms_to_mmss(progress)} / {ms_to_mmss(duration)}")
-    print(f"Shuffle: {shuffle}  |  Repeat: {repeat}")
+def on_device(sp: spotipy.Spotify, device_id: Optional[str], call):
+    """Run call(device_id). With no device_id, a 404 (no active device) retries once on `default_device`."""
+    try:
+        return call(device_id)
+    except spotify_error() as e:
+        if device_id is not None or e.http_status != 404:
+            raise
+        fallback = default_device(sp)
+        if fallback is None:
+            raise
+        return call(fallback)
 
 # -------- Commands --------
 
 def cmd_devices(sp, args):
-    print_devices(sp)
+    print_devices(sp, fatal=True)
 
 def cmd_device_set(sp, args):
     target = find_device(sp, args.device)
@@ -144,8 +83,9 @@ def cmd_device_set(sp, args):
         sys.exit(1)
     try:
         sp.transfer_playback(target, force_play=args.play)
+        invalidate_devices(sp)
         print(f"Transferred playback to device: {args.device}")
-    except spotipy.SpotifyException as e:
+    except spotify_error() as e:
         handle_spotify_exception(e, "transfer playback")
 
 def cmd_play(sp, args):
@@ -153,49 +93,49 @@ def cmd_play(sp, args):
     if args.uri:
         # If URL is given, Spotipy accepts it as-is
         try:
-            sp.start_playback(device_id=device_id, uris=[args.uri])
+            on_device(sp, device_id, lambda d: sp.start_playback(device_id=d, uris=[args.uri]))
             print("Playing:", args.uri)
-        except spotipy.SpotifyException as e:
+        except spotify_error() as e:
             handle_spotify_exception(e, "start playback (uri)")
     else:
         try:
-            sp.start_playback(device_id=device_id)
+            on_device(sp, device_id, lambda d: sp.start_playback(device_id=d))
             print("Resumed playback.")
-        except spotipy.SpotifyException as e:
+        except spotify_error() as e:
             handle_spotify_exception(e, "resume playback")
 
 def cmd_pause(sp, args):
     try:
         sp.pause_playback()
         print("Paused.")
-    except spotipy.SpotifyException as e:
+    except spotify_error() as e:
         handle_spotify_exception(e, "pause")
 
 def cmd_next(sp, args):
     try:
         sp.next_track()
         print("Skipped to next track.")
-    except spotipy.SpotifyException as e:
+    except spotify_error() as e:
         handle_spotify_exception(e, "next track")
 
 def cmd_prev(sp, args):
     try:
         sp.previous_track()
         print("Went to previous track.")
-    except spotipy.SpotifyException as e:
+    except spotify_error() as e:
         handle_spotify_exception(e, "previous track")
 
 def cmd_queue_add(sp, args):
     device_id = ensure_device(sp, args.device)
     try:
-        sp.add_to_queue(args.uri, device_id=device_id)
+        on_device(sp, device_id, lambda d: sp.add_to_queue(args.uri, device_id=d))
         print("Added to queue:", args.uri)
-    except spotipy.SpotifyException as e:
+    except spotify_error() as e:
         handle_spotify_exception(e, "add to queue")
 
 def cmd_shuffle(sp, args):
     state = args.state.lower()
-    if state not in ("on", "off", "toggle"):
+    if state not in SHUFFLE_STATES:
         print("[!] shuffle expects: on | off | toggle")
         sys.exit(1)
     try:
@@ -207,18 +147,18 @@ def cmd_shuffle(sp, args):
         else:
             sp.shuffle(state == "on")
             print(f"Shuffle {state}.")
-    except spotipy.SpotifyException as e:
+    except spotify_error() as e:
         handle_spotify_exception(e, "set shuffle")
 
 def cmd_repeat(sp, args):
     state = args.state.lower()
-    if state not in ("off", "context", "track"):
+    if state not in REPEAT_STATES:
         print("[!] repeat expects: off | context | track")
         sys.exit(1)
     try:
         sp.repeat(state)
         print(f"Repeat set to: {state}")
-    except spotipy.SpotifyException as e:
+    except spotify_error() as e:
         handle_spotify_exception(e, "set repeat")
 
 def cmd_volume(sp, args):
@@ -229,48 +169,57 @@ def cmd_volume(sp, args):
     try:
         sp.volume(pct)
         print(f"Volume set to {pct}%")
-    except spotipy.SpotifyException as e:
+    except spotify_error() as e:
         handle_spotify_exception(e, "set volume")
 
 def cmd_status(sp, args):
-    print_status(sp)
+    print_status(sp, fatal=True)
 
 def cmd_search(sp, args):
     qtype = args.type.lower()
-    if qtype not in ("track", "album", "playlist", "artist"):
+    if qtype not in SEARCH_TYPES:
         print("[!] search --type must be one of: track, album, playlist, artist")
         sys.exit(1)
 
+    # The device list is only needed to resolve --device; fetch it alongside the search.
+    fut_devices = _executor.submit(get_devices, sp) if args.play and args.device else None
     try:
         res = sp.search(q=args.query, type=qtype, limit=args.limit)
-    except spotipy.SpotifyException as e:
+    except spotify_error() as e:
         handle_spotify_exception(e, "search")
+    if fut_devices is not None:
+        try:
+            fut_devices.result()
+        except spotify_error():
+            pass  # ensure_device will retry and report the error
 
-    items_key = qtype + "s"
-    items = res.get(items_key, {}).get("items", [])
+    items = res.get(SEARCH_RESULT_KEYS[qtype], {}).get("items", [])
     if not items:
         print("No results.")
         return
 
-    # Print results
-    for i, it in enumerate(items, start=1):
+    if not args.play:
+        print_search_results(items, qtype)
+        return
+
+    uri = items[0]["uri"]
+
+    def play_top():
+        device_id = ensure_device(sp, args.device, force_play=True)
         if qtype == "track":
-            artists = ", ".join(a["name"] for a in it["artists"])
-            print(f"{i:2d}. {it['name']} — {artists}  ({it['uri']})")
+            on_device(sp, device_id, lambda d: sp.start_playback(device_id=d, uris=[uri]))
         else:
-            print(f"{i:2d}. {it['name']}  ({it['uri']})")
+            on_device(sp, device_id, lambda d: sp.start_playback(device_id=d, context_uri=uri))
 
-    if args.play:
-        uri = items[0]["uri"]
-        device_id = ensure_device(sp, args.device, force_play=True)
-        try:
-            if qtype == "track":
-                sp.start_playback(device_id=device_id, uris=[uri])
-            else:
-                sp.start_playback(device_id=device_id, context_uri=uri)
-            print(f"Playing top {qtype}: {uri}")
-        except spotipy.SpotifyException as e:
-            handle_spotify_exception(e, "start playback (search result)")
+    # Start playback first so its round-trip overlaps with printing the results.
+    # ensure_device may sys.exit in the worker; the future re-raises that here.
+    fut_play = _executor.submit(play_top)
+    print_search_results(items, qtype)
+    try:
+        fut_play.result()
+        print(f"Playing top {qtype}: {uri}")
+    except spotify_error() as e:
+        handle_spotify_exception(e, "start playback (search result)")
 
 # -------- Main / CLI --------
 
@@ -348,7 +297,7 @@ def main():
     p.set_defaults(func=cmd_search)
 
     args = parser.parse_args()
-    sp = make_spotify_client()
+    sp = make_spotify_client(one_shot=True)
     args.func(sp, args)
 
 if __name__ == "__main__":
@@ -0,0 +1,354 @@
+"""Shared Spotify client setup, caches and output helpers for spotify_cli.py and spotify_menu.py."""
+from __future__ import annotations
+
+import json
+import os
+import sys
+import threading
+import time
+from operator import itemgetter
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Optional
+
+try:
+    import orjson
+except ImportError:  # optional; falls back to requests' stdlib json decoding
+    orjson = None
+
+if TYPE_CHECKING:
+    import requests
+    import spotipy
+
+# -------- Auth --------
+
+SCOPES = [
+    "user-read-playback-state",
+    "user-modify-playback-state",
+    "user-read-currently-playing",
+]
+SCOPE_STR = " ".join(SCOPES)
+
+CACHE_PATH = Path.home() / ".config" / "spotify-cli" / ".cache"
+
+_name = itemgetter("name")
+
+def _orjson_hook(response, *args, **kwargs):
+    # spotipy decodes every body via response.json(); orjson parses the raw bytes directly.
+    # Its JSONDecodeError subclasses ValueError, which is what spotipy catches for empty bodies.
+    response.json = lambda **kw: orjson.loads(response.content)
+    return response
+
+class TokenBucket:
+    """Leaky-bucket limiter: `rate` requests/second sustained, bursts of up to `burst`."""
+
+    def __init__(self, rate: float = 10.0, burst: int = 20):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            # Reserve a token even when empty; a negative balance is our place in the queue.
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+_bucket = TokenBucket()
+
+RATE_LIMIT_RETRIES = 3
+# Longer Retry-After values (Spotify can ask for hours) are reported instead of slept through.
+MAX_RETRY_AFTER = 5.0
+
+def _retry_after(headers) -> float:
+    try:
+        return max(float(headers.get("Retry-After", 1)), 0.0)
+    except ValueError:  # HTTP-date form; Spotify sends seconds, so just back off briefly
+        return 1.0
+
+def make_session() -> requests.Session:
+    """Keep-alive session shared by the auth manager and the API client."""
+    import requests
+    import spotipy
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    class ThrottledAdapter(HTTPAdapter):
+        """Spends a bucket token per request and waits out short 429 Retry-After responses."""
+
+        def send(self, request, **kwargs):
+            for attempt in range(RATE_LIMIT_RETRIES + 1):
+                _bucket.acquire()
+                response = super().send(request, **kwargs)
+                if response.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+                    return response
+                delay = _retry_after(response.headers)
+                if delay > MAX_RETRY_AFTER:
+                    return response
+                response.close()
+                time.sleep(delay)
+
+    session = requests.Session()
+    # Same retry policy spotipy builds by default, with the pool sized for our thread pool.
+    # 429s are left to ThrottledAdapter so Retry-After is honoured (and capped) in one place;
+    # urllib3 would otherwise retry any 429 carrying Retry-After and sleep for its full value.
+    retry = Retry(
+        total=spotipy.Spotify.max_retries,
+        connect=None,
+        read=False,
+        allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+        status=spotipy.Spotify.max_retries,
+        backoff_factor=0.3,
+        status_forcelist=[code for code in spotipy.Spotify.default_retry_codes if code != 429],
+        respect_retry_after_header=False,
+    )
+    adapter = ThrottledAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if orjson is not None:
+        session.hooks["response"].append(_orjson_hook)
+    return session
+
+def _cached_token(cache_path: Path, skew: int = 60) -> Optional[str]:
+    """Return the cached access token if it covers our scopes and is valid for at least `skew` more seconds."""
+    try:
+        with open(cache_path, "rb") as f:
+            token = (orjson.loads if orjson is not None else json.loads)(f.read())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(token, dict) or "access_token" not in token:
+        return None
+    if token.get("expires_at", 0) - skew <= time.time():
+        return None
+    if not set(SCOPES) <= set((token.get("scope") or "").split()):
+        return None
+    return token["access_token"]
+
+def make_spotify_client(one_shot: bool = False) -> spotipy.Spotify:
+    """Build an authenticated client.
+
+    `one_shot` is for processes that run a single command: a fresh cached token is
+    used without the OAuth manager, and the device list is cached for the client's
+    lifetime. Long-running callers (the menu) leave it off so tokens get refreshed.
+    """
+    client_id = os.getenv("SPOTIPY_CLIENT_ID")
+    client_secret = os.getenv("SPOTIPY_CLIENT_SECRET")
+    redirect_uri = os.getenv("SPOTIPY_REDIRECT_URI", "http://127.0.0.1:8080/callback")
+
+    if not client_id or not client_secret:
+        print("[!] Missing credentials. Set SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET.", file=sys.stderr)
+        print("    You can use a .env file or export shell variables.", file=sys.stderr)
+        sys.exit(1)
+
+    # spotipy (and requests/urllib3/ssl under it) is imported only once a command
+    # actually runs, so `--help` and argument errors skip that startup cost.
+    import spotipy
+    from spotipy.oauth2 import SpotifyOAuth
+    from spotipy.cache_handler import CacheFileHandler
+
+    session = make_session()
+    token = _cached_token(CACHE_PATH) if one_shot else None
+    if token:
+        # A single command finishes long before the token expires, so skip the OAuth manager.
+        sp = spotipy.Spotify(auth=token, requests_session=session)
+    else:
+        CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        auth_manager = SpotifyOAuth(
+            client_id=client_id,
+            client_secret=client_secret,
+            redirect_uri=redirect_uri,
+            scope=SCOPE_STR,
+            cache_handler=CacheFileHandler(str(CACHE_PATH)),
+            open_browser=True,
+            show_dialog=False,
+            requests_session=session,
+        )
+        sp = spotipy.Spotify(auth_manager=auth_manager, requests_session=session)
+    if one_shot:
+        # One command invocation issues at most one /me/player/devices request.
+        enable_device_cache(sp)
+    return sp
+
+# -------- Argument values --------
+
+SHUFFLE_STATES = frozenset({"on", "off", "toggle"})
+REPEAT_STATES = frozenset({"off", "context", "track"})
+# Search type -> key of the result page in the search response.
+SEARCH_RESULT_KEYS = {"track": "tracks", "album": "albums", "playlist": "playlists", "artist": "artists"}
+SEARCH_TYPES = frozenset(SEARCH_RESULT_KEYS)
+
+# -------- Errors --------
+
+def spotify_error() -> type:
+    """Return spotipy.SpotifyException, importing spotipy on first use.
+
+    For `except spotify_error():` clauses in code that must not import spotipy at load time;
+    the expression is only evaluated once an exception is actually being matched.
+    """
+    from spotipy.exceptions import SpotifyException
+    return SpotifyException
+
+def handle_spotify_exception(e: spotipy.SpotifyException, action: str, fatal: bool = True):
+    """Explain a failed API call on stderr; exit unless `fatal` is False."""
+    status = getattr(e, "http_status", None)
+    msg = getattr(e, "msg", str(e))
+    if status == 403:
+        print(f"[!] Spotify API rejected the request (403) while trying to {action}.", file=sys.stderr)
+        print("    Playback control via Web API requires Spotify Premium.", file=sys.stderr)
+    elif status == 404:
+        print(f"[!] Resource not found while trying to {action}.", file=sys.stderr)
+    elif status == 429:
+        print(f"[!] Rate limited by Spotify (429) while trying to {action}. Wait a moment and try again.", file=sys.stderr)
+    elif status == 401:
+        print(f"[!] Unauthorized (401). Your token may be expired. Delete the cache at {CACHE_PATH} and re-auth.", file=sys.stderr)
+    else:
+        print(f"[!] Spotify API error during {action}: {msg}", file=sys.stderr)
+    if fatal:
+        sys.exit(1)
+
+# -------- Caches --------
+
+def enable_device_cache(sp: spotipy.Spotify, max_age: Optional[float] = None):
+    """Cache sp.devices() on the client, for `max_age` seconds or (None) until invalidated."""
+    sp._device_cache = {"devices": None, "fetched_at": None, "max_age": max_age, "generation": 0}
+
+def get_devices(sp: spotipy.Spotify):
+    return _device_cache(sp)["devices"]
+
+def _device_cache(sp: spotipy.Spotify) -> dict:
+    cache = getattr(sp, "_device_cache", None)
+    if cache is not None and cache["devices"] is not None:
+        max_age = cache["max_age"]
+        if max_age is None or time.time() - cache["fetched_at"] < max_age:
+            return cache
+    generation = cache["generation"] if cache is not None else None
+    d = sp.devices()
+    devices = d.get("devices", [])
+    # Lookup indexes for find_device, built once per fetch. The first device wins when
+    # names differ only in case, matching a scan of the list in order.
+    by_lower_name = {}
+    for dev in devices:
+        by_lower_name.setdefault(dev["name"].lower(), dev["id"])
+    fresh = {
+        "devices": devices,
+        "fetched_at": time.time(),
+        "by_id": {dev["id"]: dev["id"] for dev in devices},
+        "by_lower_name": by_lower_name,
+    }
+    # Don't store a list that raced with invalidate_devices (e.g. a background prefetch).
+    if cache is not None and generation == cache["generation"]:
+        cache.update(fresh)
+    return fresh
+
+def invalidate_devices(sp: spotipy.Spotify):
+    cache = getattr(sp, "_device_cache", None)
+    if cache is not None:
+        cache["devices"] = None
+        cache["fetched_at"] = None
+        cache["generation"] += 1
+
+def find_device(sp: spotipy.Spotify, query: str) -> Optional[str]:
+    """Return device_id matching id, exact name, or (case-insensitive) substring of the device name."""
+    cache = _device_cache(sp)
+    q = query.lower()
+    target = cache["by_id"].get(query) or cache["by_lower_name"].get(q)
+    if target:
+        return target
+    for name, dev_id in cache["by_lower_name"].items():
+        if q in name:
+            return dev_id
+    return None
+
+# Last current_playback() response; bursts of status/shuffle lookups within the TTL reuse it.
+_playback_cache = {"fetched_at": 0.0, "value": None, "generation": 0}
+
+def cached_playback(sp: spotipy.Spotify, ttl: float = 1.0):
+    cache = _playback_cache
+    if cache["fetched_at"] and time.monotonic() - cache["fetched_at"] < ttl:
+        return cache["value"]
+    generation = cache["generation"]
+    pb = sp.current_playback()
+    # Don't store a response that raced with a playback change.
+    if generation == cache["generation"]:
+        cache["value"] = pb
+        cache["fetched_at"] = time.monotonic()
+    return pb
+
+def invalidate_playback():
+    _playback_cache["fetched_at"] = 0.0
+    _playback_cache["value"] = None
+    _playback_cache["generation"] += 1
+
+# -------- Output --------
+
+def ms_to_mmss(ms: int) -> str:
+    if ms is None:
+        return "--:--"
+    s = int(ms // 1000)
+    return f"{s // 60:02d}:{s % 60:02d}"
+
+def artist_names(item: dict) -> str:
+    return ", ".join(map(_name, item.get("artists") or []))
+
+def write_lines(lines: List[str]):
+    """Emit `lines` with one stdout write instead of a print() (lock + flush) per line."""
+    sys.stdout.write("\n".join(lines) + "\n")
+
+def print_devices(sp: spotipy.Spotify, numbered: bool = False, fatal: bool = False) -> List[dict]:
+    try:
+        devices = get_devices(sp)
+    except spotify_error() as e:
+        handle_spotify_exception(e, "list devices", fatal=fatal)
+        return []
+    if not devices:
+        print("No available devices. Open Spotify on at least one device, then try again.")
+        return devices
+    lines = ["Devices:"]
+    for i, dev in enumerate(devices, start=1):
+        active = " (active)" if dev.get("is_active") else ""
+        vol = dev.get("volume_percent")
+        vol_str = f" vol={vol}%" if vol is not None else ""
+        bullet = f"{i:2d}." if numbered else "-"
+        lines.append(f" {bullet} {dev['name']} [{dev['type']}] id={dev['id']}{active}{vol_str}")
+    write_lines(lines)
+    return devices
+
+def print_status(sp: spotipy.Spotify, ttl: float = 1.0, fatal: bool = False):
+    try:
+        pb = cached_playback(sp, ttl)
+    except spotify_error() as e:
+        handle_spotify_exception(e, "get current playback", fatal=fatal)
+        return
+    if not pb:
+        print("Nothing is playing.")
+        return
+    item = pb.get("item")
+    is_playing = pb.get("is_playing")
+    device = pb.get("device", {})
+    progress = pb.get("progress_ms", 0)
+    shuffle = pb.get("shuffle_state")
+    repeat = pb.get("repeat_state")
+    name = item.get("name") if item else "—"
+    artists = artist_names(item) if item else "—"
+    duration = item.get("duration_ms") if item else None
+
+    write_lines([
+        f"{'▶️' if is_playing else '⏸️'} {name} — {artists}",
+        f"Device: {device.get('name','?')}  |  {ms_to_mmss(progress)} / {ms_to_mmss(duration)}",
+        f"Shuffle: {shuffle}  |  Repeat: {repeat}",
+    ])
+
+def print_search_results(items: List[dict], qtype: str):
+    lines = []
+    for i, it in enumerate(items, start=1):
+        if qtype == "track":
+            artists = artist_names(it)
+            lines.append(f"{i:2d}. {it['name']} — {artists}  ({it['uri']})")
+        else:
+            lines.append(f"{i:2d}. {it['name']}  ({it['uri']})")
+    write_lines(lines)
@@ -1,93 +1,113 @@
 #!/usr/bin/env python3
-import os
+import math
+import sched
 import sys
 import time
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 
 import spotipy
-from spotipy.oauth2 import SpotifyOAuth
-from spotipy.cache_handler import CacheFileHandler
-
-SCOPES = [
-    "user-read-playback-state",
-    "user-modify-playback-state",
-    "user-read-currently-playing",
-]
-SCOPE_STR = " ".join(SCOPES)
-
-def ms_to_mmss(ms: int) -> str:
-    if ms is None:
-        return "--:--"
-    s = int(ms // 1000)
-    return f"{s // 60:02d}:{s % 60:02d}"
-
-def make_spotify_client() -> spotipy.Spotify:
-    client_id = os.getenv("SPOTIPY_CLIENT_ID")
-    client_secret = os.getenv("SPOTIPY_CLIENT_SECRET")
-    redirect_uri = os.getenv("SPOTIPY_REDIRECT_URI", "http://127.0.0.1:8080/callback")
-
-    if not client_id or not client_secret:
-        print("[!] Missing credentials. Set SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET.", file=sys.stderr)
-        print("    You can use a .env file or export shell variables.", file=sys.stderr)
-        sys.exit(1)
-
-    cache_path = os.path.expanduser("~/.config/spotify-cli/.cache")
-    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-
-    auth_manager = SpotifyOAuth(
-        client_id=client_id,
-        client_secret=client_secret,
-        redirect_uri=redirect_uri,
-        scope=SCOPE_STR,
-        cache_handler=CacheFileHandler(cache_path),
-        open_browser=True,
-        show_dialog=False,
-    )
-    return spotipy.Spotify(auth_manager=auth_manager)
-
-def print_status(sp: spotipy.Spotify):
-    try:
-        pb = sp.current_playback()
-    except spotipy.SpotifyException as e:
-        print_api_error(e, "get current playback")
-        return
-    if not pb:
-        print("Nothing is playing.")
-        return
-    item = pb.get("item")
-    is_playing = pb.get("is_playing")
-    device = pb.get("device", {})
-    progress = pb.get("progress_ms", 0)
-    shuffle = pb.get("shuffle_state")
-    repeat = pb.get("repeat_state")
-    name = item.get("name") if item else "—"
-    artists = ", ".join(a["name"] for a in (item.get("artists") or [])) if item else "—"
-    duration = item.get("duration_ms") if item else None
-
-    print(f"{'▶️' if is_playing else '⏸️'} {name} — {artists}")
-    print(f"Device: {device.get('name','?')}  |  {ms_to_mmss(progress)} / {ms_to_mmss(duration)}")
-    print(f"Shuffle: {shuffle}  |  Repeat: {repeat}")
-
-def print_devices(sp: spotipy.Spotify):
+
+from spotify_core import (
+    REPEAT_STATES,
+    SEARCH_RESULT_KEYS,
+    SEARCH_TYPES,
+    SHUFFLE_STATES,
+    artist_names,
+    cached_playback,
+    enable_device_cache,
+    get_devices,
+    handle_spotify_exception,
+    invalidate_devices,
+    invalidate_playback,
+    make_spotify_client,
+    print_devices,
+    print_search_results,
+    print_status,
+)
+
+# Piped/scripted input gets no UX pause between commands.
+_INTERACTIVE = sys.stdin.isatty()
+
+# Background pool for prefetches that can overlap with waiting on the prompt.
+_executor = ThreadPoolExecutor(max_workers=2)
+
+# How old a (usually prefetched) playback response may be for the Status option.
+STATUS_MAX_AGE = 3.0
+
+class PollScheduler:
+    """Plan status polls over the rest of the current track.
+
+    The next state change is modelled as uniform over the remaining time U, so
+    the optimal placement L_i = (F(L_{i-1}) - F(L_{i-2})) / p(L_{i-1}) + L_{i-1}
+    spaces the budgeted polls evenly up to U, with a final poll just after the
+    track is expected to end.
+    """
+
+    def __init__(self, remaining_ms: Optional[int], per_minute: int = 6, end_slack: float = 1.0):
+        self.remaining = None if remaining_ms is None else max(remaining_ms, 0) / 1000
+        self.per_minute = per_minute
+        self.end_slack = end_slack
+
+    @classmethod
+    def from_playback(cls, pb, per_minute: int = 6) -> "PollScheduler":
+        item = pb.get("item") if pb else None
+        if not pb or not pb.get("is_playing") or not item:
+            return cls(None, per_minute)
+        return cls(item.get("duration_ms", 0) - (pb.get("progress_ms") or 0), per_minute)
+
+    def delays(self) -> List[float]:
+        """Seconds from now at which to poll."""
+        interval = 60 / self.per_minute
+        if self.remaining is None:
+            # Paused / idle: nothing to anticipate, just spend the budget evenly.
+            return [interval]
+        n = max(math.ceil(self.remaining / interval), 1)
+        step = self.remaining / n
+        return [step * i for i in range(1, n)] + [self.remaining + self.end_slack]
+
+def watch_status(sp: spotipy.Spotify, per_minute: int = 6):
+    """Live status view; polls are re-planned whenever the playing track or state changes."""
+    scheduler = sched.scheduler(time.monotonic, time.sleep)
+    last = {"key": None}
+
+    def poll():
+        print_status(sp)
+        try:
+            pb = cached_playback(sp)
+        except spotipy.SpotifyException:
+            pb = None
+        item = pb.get("item") if pb else None
+        key = (item.get("id") if item else None, bool(pb and pb.get("is_playing")))
+        if key != last["key"] or scheduler.empty():
+            last["key"] = key
+            for event in scheduler.queue:
+                scheduler.cancel(event)
+            for delay in PollScheduler.from_playback(pb, per_minute).delays():
+                scheduler.enter(delay, 1, poll)
+        print()
+
+    print("Watching playback (Ctrl+C to return to the menu).\n")
+    scheduler.enter(0, 1, poll)
     try:
-        d = sp.devices()
-    except spotipy.SpotifyException as e:
-        print_api_error(e, "list devices")
-        return []
-    devices = d.get("devices", [])
-    if not devices:
-        print("No available devices. Open Spotify on at least one device, then try again.")
-    else:
-        print("Devices:")
-        for i, dev in enumerate(devices, start=1):
-            active = " (active)" if dev.get("is_active") else ""
-            vol = dev.get("volume_percent")
-            vol_str = f" vol={vol}%" if vol is not None else ""
-            print(f" {i:2d}. {dev['name']} [{dev['type']}] id={dev['id']}{active}{vol_str}")
-    return devices
+        scheduler.run()
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+
+def invalidate_state(sp: spotipy.Spotify):
+    # Playback changes can also flip a device's is_active / volume_percent in the device list.
+    invalidate_playback()
+    invalidate_devices(sp)
+    prefetch_state(sp)
+
+def prefetch_state(sp: spotipy.Spotify):
+    # Refetch playback and devices in parallel while the user reads the menu; Status and
+    # Devices reuse the results while they are still fresh.
+    _executor.submit(cached_playback, sp)
+    _executor.submit(get_devices, sp)
 
 def choose_device(sp: spotipy.Spotify) -> Optional[str]:
-    devices = print_devices(sp)
+    devices = print_devices(sp, numbered=True)
     if not devices:
         return None
     try:
@@ -100,24 +120,15 @@ def choose_device(sp: spotipy.Spotify) -> Optional[str]:
             return None
         target = devices[idx]["id"]
         sp.transfer_playback(target, force_play=False)
+        invalidate_state(sp)
         print(f"Transferred playback to: {devices[idx]['name']}")
         return target
     except ValueError:
         print("[!] Please enter a number.")
     except spotipy.SpotifyException as e:
-        print_api_error(e, "transfer playback")
+        handle_spotify_exception(e, "transfer playback", fatal=False)
     return None
 
-def print_api_error(e: spotipy.SpotifyException, action: str):
-    status = getattr(e, "http_status", None)
-    msg = getattr(e, "msg", str(e))
-    if status == 403:
-        print(f"[!] 403 while trying to {action}. Spotify Premium is required for playback control.")
-    elif status == 401:
-        print("[!] 401 Unauthorized. Your token may be expired. Delete the cache at ~/.config/spotify-cli/.cache and re-auth.")
-    else:
-        print(f"[!] Spotify API error during {action}: {msg}")
-
 def prompt(prompt_text: str) -> str:
     try:
         return input(prompt_text)
@@ -140,19 +151,26 @@ def main_menu():
     print("11) Switch device")
     print("12) Play a specific URI/URL")
     print("13) Search & (optionally) play")
-    print("14) Refresh")
+    print("14) Refresh (live)")
     print("15) Quit")
     choice = prompt("\nSelect option #: ").strip()
     return choice
 
 def run():
     sp = make_spotify_client()
+    # Authorize on the main thread before any background prefetch: on first run the
+    # OAuth flow opens a browser and a local callback server, which must happen once.
+    sp.auth_manager.get_access_token(as_dict=False)
+    # Devices change rarely but not never (apps opening/closing elsewhere), so keep them briefly.
+    enable_device_cache(sp, max_age=30.0)
+    # Warm both caches now so the first Status / Devices pick is usually instant.
+    prefetch_state(sp)
     while True:
         try:
             choice = main_menu()
 
             if choice == "1":
-                print_status(sp)
+                print_status(sp, ttl=STATUS_MAX_AGE)
 
             elif choice == "2":
                 try:
@@ -163,7 +181,8 @@ def run():
                         sp.pause_playback()
                     except:
                         print("Paused.")
-                        # print_api_error(e, "resume playback")
+                        # handle_spotify_exception(e, "resume playback", fatal=False)
+                invalidate_state(sp)
 
             elif choice == "3":
                 try:
@@ -174,21 +193,24 @@ def run():
                         sp.start_playback()
                     except:
                         print("Resumed playback.")
-                        # print_api_error(e, "pause")
+                        # handle_spotify_exception(e, "pause", fatal=False)
+                invalidate_state(sp)
 
             elif choice == "4":
                 try:
                     sp.next_track()
+                    invalidate_state(sp)
                     print("Skipped to next track.")
                 except spotipy.SpotifyException as e:
-                    print_api_error(e, "next track")
+                    handle_spotify_exception(e, "next track", fatal=False)
 
             elif choice == "5":
                 try:
                     sp.previous_track()
+                    invalidate_state(sp)
                     print("Went to previous track.")
                 except spotipy.SpotifyException as e:
-                    print_api_error(e, "previous track")
+                    handle_spotify_exception(e, "previous track", fatal=False)
 
             elif choice == "6":
                 uri = prompt("Track URI/URL to add to queue: ").strip()
@@ -197,7 +219,7 @@ def run():
                         sp.add_to_queue(uri)
                         print("Added to queue.")
                     except spotipy.SpotifyException as e:
-                        print_api_error(e, "add to queue")
+                        handle_spotify_exception(e, "add to queue", fatal=False)
 
             elif choice == "7":
                 val = prompt("Volume (0–100): ").strip()
@@ -205,6 +227,7 @@ def run():
                     pct = int(val)
                     if 0 <= pct <= 100:
                         sp.volume(pct)
+                        invalidate_state(sp)
                         print(f"Volume set to {pct}%")
                     else:
                         print("[!] Volume must be 0–100.")
@@ -213,34 +236,37 @@ def run():
 
             elif choice == "8":
                 state = prompt("Shuffle (on/off/toggle): ").strip().lower()
-                if state not in ("on","off","toggle"):
+                if state not in SHUFFLE_STATES:
                     print("[!] Use on/off/toggle.")
                 else:
                     try:
                         if state == "toggle":
-                            pb = sp.current_playback()
+                            pb = cached_playback(sp)
                             cur = pb.get("shuffle_state") if pb else False
                             sp.shuffle(not cur)
+                            invalidate_state(sp)
                             print(f"Shuffle {'on' if not cur else 'off'}.")
                         else:
                             sp.shuffle(state == "on")
+                            invalidate_state(sp)
                             print(f"Shuffle {state}.")
                     except spotipy.SpotifyException as e:
-                        print_api_error(e, "set shuffle")
+                        handle_spotify_exception(e, "set shuffle", fatal=False)
 
             elif choice == "9":
                 state = prompt("Repeat (off/context/track): ").strip().lower()
-                if state not in ("off","context","track"):
+                if state not in REPEAT_STATES:
                     print("[!] Use off/context/track.")
                 else:
                     try:
                         sp.repeat(state)
+                        invalidate_state(sp)
                         print(f"Repeat set to {state}.")
                     except spotipy.SpotifyException as e:
-                        print_api_error(e, "set repeat")
+                        handle_spotify_exception(e, "set repeat", fatal=False)
 
             elif choice == "10":
-                print_devices(sp)
+                print_devices(sp, numbered=True)
 
             elif choice == "11":
                 choose_device(sp)
@@ -253,34 +279,33 @@ def run():
                 try:
                     if "track" in uri:
                         sp.start_playback(uris=[uri])
+                        invalidate_state(sp)
                     else:
                         sp.start_playback(context_uri=uri)
+                        invalidate_state(sp)
                     print("Started playback.")
                 except spotipy.SpotifyException as e:
-                    print_api_error(e, "start playback")
+                    handle_spotify_exception(e, "start playback", fatal=False)
 
             elif choice == "13":
                 q = prompt("Search query: ").strip()
                 t = prompt("Type (track/album/playlist/artist) [default: track]: ").strip().lower() or "track"
+                if t not in SEARCH_TYPES:
+                    print("[!] Use track/album/playlist/artist.")
+                    continue
                 try:
                     res = sp.search(q=q, type=t, limit=10)
                 except spotipy.SpotifyException as e:
-                    print_api_error(e, "search")
+                    handle_spotify_exception(e, "search", fatal=False)
                     continue
 
-                items_key = t + "s"
-                items = res.get(items_key, {}).get("items", [])
+                items = res.get(SEARCH_RESULT_KEYS[t], {}).get("items", [])
                 if not items:
                     print("No results.")
                     continue
 
                 # Show results
-                for i, it in enumerate(items, start=1):
-                    if t == "track":
-                        artists = ", ".join(a["name"] for a in it["artists"])
-                        print(f"{i:2d}. {it['name']} — {artists}  ({it['uri']})")
-                    else:
-                        print(f"{i:2d}. {it['name']}  ({it['uri']})")
+                print_search_results(items, t)
 
                 sel = prompt("Select result # (Enter to cancel): ").strip()
                 if not sel:
@@ -309,11 +334,13 @@ def run():
                     try:
                         if t == "track":
                             sp.start_playback(uris=[uri])
+                            invalidate_state(sp)
                         else:
                             sp.start_playback(context_uri=uri)
+                            invalidate_state(sp)
                         print("Playing selection.")
                     except spotipy.SpotifyException as e:
-                        print_api_error(e, "start playback from search")
+                        handle_spotify_exception(e, "start playback from search", fatal=False)
 
                 elif act == "2":
                     # If it’s a track, queue directly. Otherwise, auto re-search for a top track and queue that.
@@ -321,10 +348,10 @@ def run():
                         try:
                             sp.add_to_queue(uri)
                             name = chosen.get("name", "track")
-                            artists = ", ".join(a["name"] for a in chosen.get("artists", []))
+                            artists = artist_names(chosen)
                             print(f"Added to queue: {name} — {artists}")
                         except spotipy.SpotifyException as e:
-                            print_api_error(e, "add to queue from search")
+                            handle_spotify_exception(e, "add to queue from search", fatal=False)
                     else:
                         # Auto re-search for a track using the same query q and queue the top result
                         try:
@@ -336,17 +363,16 @@ def run():
                             top_track = top[0]
                             sp.add_to_queue(top_track["uri"])
                             t_name = top_track.get("name", "track")
-                            t_artists = ", ".join(a["name"] for a in top_track.get("artists", []))
+                            t_artists = artist_names(top_track)
                             print(f"Added to queue (top track for query): {t_name} — {t_artists}")
                         except spotipy.SpotifyException as e:
-                            print_api_error(e, "auto-queue top track from query")
+                            handle_spotify_exception(e, "auto-queue top track from query", fatal=False)
                 else:
                     print("[!] Unknown choice.")
 
 
             elif choice == "14":
-                # Just loop to refresh
-                print_status(sp)
+                watch_status(sp)
 
             elif choice == "15":
                 print("Goodbye!")
@@ -356,7 +382,9 @@ def run():
                 print("[!] Unknown option.")
 
             # tiny pause for nicer UX
-            time.sleep(0.3)
+            sys.stdout.flush()
+            if _INTERACTIVE:
+                time.sleep(0.3)
 
         except (KeyboardInterrupt, EOFError):
             print("\nGoodbye!")